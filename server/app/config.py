@@ -19,6 +19,31 @@ from os import path, getcwd
 #    └── ...
 tasks_dir = path.expanduser("~/tasks")
 
+# database the tasks are persisted in
+tasks_db = path.join(tasks_dir, 'tasks.db')
+
+# paths relative to a task directory, joined once at import
+dataset_subdir = 'dataset'
+images_subdir = path.join(dataset_subdir, 'images')
+transforms_subpath = path.join(dataset_subdir, 'transforms.json')
+input_video_subpath = path.join(dataset_subdir, 'input_video.mp4')
+model_subdir = 'model'
+log_subpath = 'log.txt'
+output_video_subpath = path.join('output', 'render_output.mp4')
+
 colmap_tmp_dir = path.expanduser("~/.colmap-tmp")
 
-colmap_script = path.join(getcwd(), path.pardir, 'scripts', 'colmap2nerf.py')
\ No newline at end of file
+colmap_script = path.join(getcwd(), path.pardir, 'scripts', 'colmap2nerf.py')
+
+# number of tasks kept, the oldest finished tasks and their files are deleted
+# past this
+max_tasks = 1024
+
+# number of tasks accepted but not finished yet before new tasks are rejected
+max_tasks_in_flight = 10
+
+# number of tasks allowed to preprocess at once (colmap already uses every core)
+preprocess_slots = 1
+
+# number of GPUs, each one trains or renders one task at a time
+gpu_count = 1
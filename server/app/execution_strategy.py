@@ -1,31 +1,98 @@
 from abc import ABC, abstractmethod
 import asyncio
-from typing import Union
+from functools import partial
+import logging
+import signal
+import subprocess
+from typing import ClassVar, List, Tuple, Union
 import os
-from os import makedirs, path
 
 from models import Task
 from config import *
+from log_writer import log_writer
+
+
+logger = logging.getLogger(__name__)
+
+def _find_config(model_dir: str) -> Union[str, None]:
+    """
+    Find the config.yml file written by ns-train under model_dir
+
+    DirEntry.is_file/is_dir reuse the file type returned by readdir so no
+    extra stat call is made per entry. return None if no config file is found
+    """
+    stack = [model_dir]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(".yml") and entry.is_file():
+                        return entry.path
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def _forward_output(proc: subprocess.Popen, task: Task,
+                    loop: asyncio.AbstractEventLoop) -> int:
+    """Pass each line of output from proc to the log writer until it exits"""
+    with proc.stdout:
+        for line in proc.stdout:
+            loop.call_soon_threadsafe(log_writer.put, task, line)
+    return proc.wait()
+
+
+def _terminate(proc: subprocess.Popen, grace_period: float = 10):
+    """Terminate the process group of proc, kill it if it does not exit"""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        try:
+            proc.wait(timeout=grace_period)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+    except ProcessLookupError:
+        pass
+
+
+async def _stop_program(spawn: asyncio.Future,
+                        output: Union[asyncio.Future, None], task: Task):
+    """Terminate a program started by exec_program and log its last output"""
+    try:
+        proc = await spawn
+    except Exception:
+        # the program was never started
+        return
+    await asyncio.get_running_loop().run_in_executor(None, _terminate, proc)
+    if output is None:
+        proc.stdout.close()
+    else:
+        await output
+    await log_writer.flush(task)
 
 
 class ExecutionStrategy(ABC):
-    @classmethod
-    @abstractmethod
-    def preprocess_timeout(cls) -> float:
-        """Timeout for the preprocessing step in seconds"""
-        raise NotImplementedError()
-
-    @classmethod
-    @abstractmethod
-    def train_timeout(cls) -> float:
-        """Timeout for the training step in seconds"""
-        raise NotImplementedError()
-
-    @classmethod
-    @abstractmethod
-    def render_timeout(cls) -> float:
-        """Timeout for the rendering step in seconds"""
-        raise NotImplementedError()
+    # timeouts of the preprocessing, training and rendering steps in seconds
+    preprocess_timeout: ClassVar[float]
+    train_timeout: ClassVar[float]
+    render_timeout: ClassVar[float]
+
+    # arguments for colmap2nerf.py, which are the same for every task
+    _PREPROCESS_ARGS = (
+        colmap_script,
+        "--run_colmap",
+        "--colmap_matcher", "exhaustive",
+        "--aabb_scale", "16",
+    )
+    # ns-train and ns-render argument templates, see _format_argv
+    _TRAIN_ARGV: Tuple[str, ...] = ()
+    _RENDER_ARGV = (
+        "--load-config", "{config}",
+        "--traj", "spiral",
+        "--output-path", "{output}",
+    )
 
     @classmethod
     @abstractmethod
@@ -45,6 +112,11 @@ class ExecutionStrategy(ABC):
         """Run render on task"""
         raise NotImplementedError()
 
+    @staticmethod
+    def _format_argv(argv: Tuple[str, ...], **values: str) -> List[str]:
+        """Fill in the {placeholders} of an argument template"""
+        return [arg.format_map(values) for arg in argv]
+
     @staticmethod
     async def exec_program(task: Task, program: str,
                            *args: str, cwd: Union[str, None]=None):
@@ -53,172 +125,140 @@ class ExecutionStrategy(ABC):
 
         throw RuntimeException on non-zero return code
         """
-        log_file = task.log_file()
-        makedirs(path.dirname(log_file), exist_ok=True)
-        print(f'Executing "{" ".join([program, *args])}"')
+        logger.debug("Executing %s with arguments %s", program, args)
+        # pin the program to the GPU reserved for the task
+        env = None
+        if task.gpu is not None:
+            env = {**os.environ, "CUDA_VISIBLE_DEVICES": str(task.gpu)}
         # return
-        with open(log_file, "a+", encoding="utf8") as f:
-            proc = await asyncio.create_subprocess_exec(
-                program, *args, stderr=f, stdout=f, cwd=cwd)
-        status = await proc.wait()
+        loop = asyncio.get_running_loop()
+        # spawn and wait from worker threads so that forking the server
+        # process never stalls the event loop
+        # the program gets its own process group so that the programs it
+        # starts itself (e.g. colmap) can be terminated together with it
+        spawn = loop.run_in_executor(None, partial(
+            subprocess.Popen, [program, *args],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd,
+            env=env, start_new_session=True))
+        output = None
+        try:
+            # shielded so that the futures can still be awaited once the step
+            # is cancelled
+            proc = await asyncio.shield(spawn)
+            output = loop.run_in_executor(
+                None, _forward_output, proc, task, loop)
+            status = await asyncio.shield(output)
+        except asyncio.CancelledError:
+            # the step timed out or the server is stopping, do not leave the
+            # program running and wait for it to exit so that its GPU is free
+            # and its output is written once the step returns
+            await asyncio.shield(_stop_program(spawn, output, task))
+            raise
+        await log_writer.flush(task)
         if status != 0:
             err_msg = f'Program "{" ".join([program, *args])}" exit with status code {status}'
             raise RuntimeError(err_msg)
 
 
 class NerfactoStrategy(ExecutionStrategy):
-    @classmethod
-    def preprocess_timeout(cls):
-        return 60 * 20  # 20 minutes
-
-    @classmethod
-    def train_timeout(cls):
-        return 60 * 25  # 25 minutes
+    _TRAIN_ARGV = (
+        "nerfacto", "--data", "{dataset}",
+        "--trainer.max-num-iterations", "17000",
+        "--output-dir", "{model}",
+    )
 
-    @classmethod
-    def render_timeout(cls):
-        return 60 * 5  # 5 minutes
+    preprocess_timeout = 60 * 20  # 20 minutes
+    train_timeout = 60 * 25  # 25 minutes
+    render_timeout = 60 * 5  # 5 minutes
 
     @classmethod
     async def preprocess(cls, task: Task):
-        args = f"""
-            {colmap_script}
-            --run_colmap
-            --colmap_matcher exhaustive
-            --aabb_scale 16
-            """
-        await cls.exec_program(task, "python3.8", *args.split(),
-                               cwd=task.dataset_dir())
+        await cls.exec_program(task, "python3.8", *cls._PREPROCESS_ARGS,
+                               cwd=task.dataset_dir)
 
     @classmethod
     async def train(cls, task: Task):
-        args = f"""
-            nerfacto
-            --data {task.dataset_dir()}
-            --trainer.max-num-iterations 17000
-            --output-dir {task.model_dir()}
-            """
-        await cls.exec_program(task, "ns-train", *args.split())
+        args = cls._format_argv(
+            cls._TRAIN_ARGV, dataset=task.dataset_dir, model=task.model_dir)
+        await cls.exec_program(task, "ns-train", *args)
+        task.config_file = _find_config(task.model_dir)
 
     @classmethod
     async def render(cls, task: Task):
-        config_file = None
-        for dirpath, _dirnames, filenames in os.walk(task.model_dir()):
-            for filename in [f for f in filenames if f.endswith(".yml")]:
-                config_file = os.path.join(dirpath, filename)
-                break
-            if config_file:
-                break
+        # training may have timed out before recording the config file
+        config_file = task.config_file or _find_config(task.model_dir)
         if not config_file:
             raise RuntimeError("Cannot find config.yml file for ns-render")
-        args = f"""
-            --load-config {config_file}
-            --traj spiral
-            --output-path {task.output_video_file()}
-            """
-        await cls.exec_program(task, "ns-render", *args.split())
+        args = cls._format_argv(
+            cls._RENDER_ARGV, config=config_file,
+            output=task.output_video_file)
+        await cls.exec_program(task, "ns-render", *args)
 
 
 class InstantNgpStrategy(ExecutionStrategy):
-    @classmethod
-    def preprocess_timeout(cls):
-        return 60 * 20  # 20 minutes
-
-    @classmethod
-    def train_timeout(cls):
-        return 60 * 10  # 10 minutes
+    _TRAIN_ARGV = (
+        "instant-ngp", "--data", "{dataset}",
+        "--output-dir", "{model}",
+    )
 
-    @classmethod
-    def render_timeout(cls):
-        return 60 * 5  # 5 minutes
+    preprocess_timeout = 60 * 20  # 20 minutes
+    train_timeout = 60 * 10  # 10 minutes
+    render_timeout = 60 * 5  # 5 minutes
 
     @classmethod
     async def preprocess(cls, task: Task):
-        args = f"""
-            {colmap_script}
-            --run_colmap
-            --colmap_matcher exhaustive
-            --aabb_scale 16
-            """
-        await cls.exec_program(task, "python3.8", *args.split(),
-                               cwd=task.dataset_dir())
+        await cls.exec_program(task, "python3.8", *cls._PREPROCESS_ARGS,
+                               cwd=task.dataset_dir)
 
     @classmethod
     async def train(cls, task: Task):
-        args = f"""
-            instant-ngp
-            --data {task.dataset_dir()}
-            --output-dir {task.model_dir()}
-            """
-        await cls.exec_program(task, "ns-train", *args.split())
+        args = cls._format_argv(
+            cls._TRAIN_ARGV, dataset=task.dataset_dir, model=task.model_dir)
+        await cls.exec_program(task, "ns-train", *args)
+        task.config_file = _find_config(task.model_dir)
 
     @classmethod
     async def render(cls, task: Task):
-        config_file = None
-        for dirpath, _dirnames, filenames in os.walk(task.model_dir()):
-            for filename in [f for f in filenames if f.endswith(".yml")]:
-                config_file = os.path.join(dirpath, filename)
-                break
-            if config_file:
-                break
+        # training may have timed out before recording the config file
+        config_file = task.config_file or _find_config(task.model_dir)
         if not config_file:
             raise RuntimeError("Cannot find config.yml file for ns-render")
-        args = f"""
-            --load-config {config_file}
-            --traj spiral
-            --output-path {task.output_video_file()}
-            """
-        await cls.exec_program(task, "ns-render", *args.split())
+        args = cls._format_argv(
+            cls._RENDER_ARGV, config=config_file,
+            output=task.output_video_file)
+        await cls.exec_program(task, "ns-render", *args)
 
 
 class VanillaNerfStrategy(ExecutionStrategy):
-    @classmethod
-    def preprocess_timeout(cls):
-        return 60 * 20  # 20 minutes
+    _TRAIN_ARGV = (
+        "vanilla-nerf", "--data", "{dataset}",
+        "--output-dir", "{model}",
+    )
 
-    @classmethod
-    def train_timeout(cls):
-        return 60 * 45  # 45 minutes
-
-    @classmethod
-    def render_timeout(cls):
-        return 60 * 5  # 5 minutes
+    preprocess_timeout = 60 * 20  # 20 minutes
+    train_timeout = 60 * 45  # 45 minutes
+    render_timeout = 60 * 5  # 5 minutes
 
     @classmethod
     async def preprocess(cls, task: Task):
-        args = f"""
-            {colmap_script}
-            --run_colmap
-            --colmap_matcher exhaustive
-            --aabb_scale 16
-            """
-        await cls.exec_program(task, "python3.8", *args.split(),
-                               cwd=task.dataset_dir())
+        await cls.exec_program(task, "python3.8", *cls._PREPROCESS_ARGS,
+                               cwd=task.dataset_dir)
 
     @classmethod
     async def train(cls, task: Task):
-        args = f"""
-            vanilla-nerf
-            --data {task.dataset_dir()}
-            --output-dir {task.model_dir()}
-            """
-        await cls.exec_program(task, "ns-train", *args.split())
+        args = cls._format_argv(
+            cls._TRAIN_ARGV, dataset=task.dataset_dir, model=task.model_dir)
+        await cls.exec_program(task, "ns-train", *args)
+        task.config_file = _find_config(task.model_dir)
 
     @classmethod
     async def render(cls, task: Task):
-        config_file = None
-        for dirpath, _dirnames, filenames in os.walk(task.model_dir()):
-            for filename in [f for f in filenames if f.endswith(".yml")]:
-                config_file = os.path.join(dirpath, filename)
-                break
-            if config_file:
-                break
+        # training may have timed out before recording the config file
+        config_file = task.config_file or _find_config(task.model_dir)
         if not config_file:
             raise RuntimeError("Cannot find config.yml file for ns-render")
-        args = f"""
-            --load-config {config_file}
-            --traj spiral
-            --output-path {task.output_video_file()}
-            """
-        await cls.exec_program(task, "ns-render", *args.split())
+        args = cls._format_argv(
+            cls._RENDER_ARGV, config=config_file,
+            output=task.output_video_file)
+        await cls.exec_program(task, "ns-render", *args)
 
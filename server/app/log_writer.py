@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List, Tuple, Union
+
+from models import Task, FINISHED_STATUSES
+
+
+logger = logging.getLogger(__name__)
+
+
+class LogWriter:
+    """
+    Append subprocess output to the task log files from a single coroutine
+
+    Lines queued within max_delay seconds of each other are written to each
+    log file with one write call
+    """
+
+    def __init__(self, max_lines: int = 256, max_delay: float = 0.1):
+        self.max_lines = max_lines
+        self.max_delay = max_delay
+        self.queue: Union[asyncio.Queue, None] = None
+        self.writer_task: Union[asyncio.Task, None] = None
+
+    def start(self):
+        """Start the writer coroutine on the running event loop"""
+        self.queue = asyncio.Queue()
+        self.writer_task = asyncio.create_task(self._write())
+
+    def put(self, task: Task, line: bytes):
+        """Queue a line to be appended to the log file of task"""
+        self.queue.put_nowait((task, line))
+
+    async def flush(self, task: Task):
+        """Wait until every line queued so far is written"""
+        done = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((task, done))
+        await done
+
+    async def _write(self):
+        while True:
+            batch = [await self.queue.get()]
+            # give other lines a moment to arrive so they share the write
+            await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_lines and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                self._write_batch(batch)
+            except Exception:
+                # a single bad batch must not stop the writer, flush() would
+                # wait forever afterwards
+                logger.exception("Failed to write task logs")
+
+    @staticmethod
+    def _write_batch(batch: List[Tuple[Task, Union[bytes, asyncio.Future]]]):
+        lines: Dict[str, Tuple[Task, List[bytes]]] = dict()
+        flushed: List[asyncio.Future] = []
+        for task, item in batch:
+            if isinstance(item, bytes):
+                lines.setdefault(task.id, (task, []))[1].append(item)
+            else:
+                flushed.append(item)
+        try:
+            for task, task_lines in lines.values():
+                # the log of a finished task is closed, do not open it again
+                if task.status in FINISHED_STATUSES:
+                    continue
+                data = memoryview(b"".join(task_lines))
+                try:
+                    fd = task.log_fd()
+                    while data:
+                        data = data[os.write(fd, data):]
+                except OSError:
+                    logger.exception("Failed to write log of task %s", task.id)
+        finally:
+            for done in flushed:
+                # the step waiting in flush() may have been cancelled
+                if not done.done():
+                    done.set_result(None)
+
+
+log_writer = LogWriter()
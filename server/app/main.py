@@ -1,12 +1,28 @@
+import asyncio
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import platform
+import queue
+import re
+import shutil
+import sys
+from typing import List
+
 from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response
 
 from uvicorn.config import Config
 from uvicorn.main import Server
 
-from models import *
-from task_manager import TaskManager
+from models import ExecutionStrategy, Task
+from task_manager import TaskManager, STRATEGIES
+
 
+# log records are handed to a background thread through a queue so that
+# writing them out never blocks the event loop
+log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
 
 app = FastAPI()
 
@@ -16,12 +32,15 @@ manager: TaskManager
 @app.on_event("startup")
 async def startup_event():
     global manager
+    log_listener.start()
     manager = TaskManager()
+    await manager.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    pass
+    await manager.stop()
+    log_listener.stop()
 
 
 @app.get("/")
@@ -46,7 +65,7 @@ async def index():
 
 @app.get("/tasks", response_model=List[Task])
 async def get_tasks():
-    return manager.list()
+    return Response(content=manager.list_json(), media_type="application/json")
 
 
 @app.get("/tasks/{task_id}", response_model=Task)
@@ -62,7 +81,18 @@ async def get_task_output(task_id: str):
     task = manager.get(task_id)
     if not task:
         raise HTTPException(status_code=404, detail="task not found")
-    return FileResponse(task.output_video_file())
+    return FileResponse(task.output_video_file)
+
+
+@app.delete("/tasks/{task_id}")
+async def delete_task(task_id: str):
+    task = manager.get(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="task not found")
+    if not manager.cancel(task_id):
+        raise HTTPException(
+                status_code=409, detail="Only queued tasks can be cancelled")
+    return JSONResponse(content={'id': task.id})
 
 
 @app.post("/tasks")
@@ -70,26 +100,53 @@ async def post_tasks(
     file: UploadFile = File(""),
     strategy: ExecutionStrategy = ExecutionStrategy.nerfacto,
 ):
-    if strategy in {"nerfacto", "instant-ngp", "vanilla-nerf"}:
-        task = Task.new(strategy)
-    else:
+    if strategy not in STRATEGIES:
         raise HTTPException(status_code=400, detail='"strategy" must be either "nerfacto", "instant-ngp", "vanilla-nerf".')
-
-    if file.content_type in {"video/quicktime", "video/mp4"}:
-        task.upload_video(file)
-    elif file.content_type in {"img/jpeg"}:
-        task.upload_images(file)
-    else:
-        raise HTTPException(status_code=400, detail="Media type must be either \"video/quicktime\" or \"img/jpeg\"")
-
-    success = manager.add(task)
+    task = Task.new(strategy)
+
+    success = False
+    try:
+        if file.content_type in {"video/quicktime", "video/mp4"}:
+            try:
+                await task.upload_video(file)
+            except RuntimeError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        elif file.content_type in {"img/jpeg"}:
+            await task.upload_images([file])
+        else:
+            raise HTTPException(status_code=400, detail="Media type must be either \"video/quicktime\" or \"img/jpeg\"")
+
+        success = await manager.add(task)
+    finally:
+        # the task manager closes the log of accepted tasks when they finish
+        # and deletes their files on eviction, nothing tracks rejected ones
+        if not success:
+            task.close_log()
+            await asyncio.to_thread(shutil.rmtree, task.task_dir, True)
     if not success:
         raise HTTPException(
                 status_code=500, detail="Too many tasks queued. Try again later")
     return JSONResponse(status_code=201, content={'id': task.id})
 
 
+def install_event_loop_policy():
+    """
+    Run the server on the io_uring based event loop of uringcore when it is
+    installed and the kernel supports it, keep the default loop otherwise
+    """
+    try:
+        import uringcore
+    except ImportError:
+        return
+    version = re.match(r"(\d+)\.(\d+)", platform.release())
+    if sys.platform != "linux" or not version or \
+            tuple(map(int, version.groups())) < (5, 11):
+        return
+    asyncio.set_event_loop_policy(uringcore.EventLoopPolicy())
+
+
 if __name__ == "__main__":
+    install_event_loop_policy()
     config = Config(app=app, loop="asyncio")
     server = Server(config=config)
     server.run()
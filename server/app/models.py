@@ -1,15 +1,54 @@
-from typing import List, Union
+import asyncio
+from typing import Callable, Dict, List, Union
 from datetime import datetime
 from enum import Enum
-from os import makedirs, path, system
+from functools import partial, wraps
+import os
+import shutil
+from os import makedirs, path
 
 from uuid import uuid4
 from fastapi import UploadFile
-from pydantic import BaseModel
+from pydantic import BaseModel, Extra, PrivateAttr
 
 from config import *
 
 
+def _cached_path(method: Callable[["Task"], str]) -> property:
+    """Turn a Task path method into a property computed once per task"""
+    name = method.__name__
+
+    @wraps(method)
+    def getter(self: "Task") -> str:
+        if name not in self._paths:
+            self._paths[name] = method(self)
+        return self._paths[name]
+
+    return property(getter)
+
+
+def _save_upload(file: UploadFile, dest: str,
+                 dir_fd: Union[int, None] = None):
+    """
+    Stream the content of an uploaded file to dest
+
+    dest is resolved relative to the directory dir_fd when it is given
+    """
+    src = file.file
+    with open(dest, 'wb+', opener=partial(os.open, dir_fd=dir_fd)) as f:
+        # uploads over the spooling threshold are already in a temporary file
+        # on disk, copy those inside the kernel
+        if getattr(src, '_rolled', False):
+            offset = src.tell()
+            while True:
+                sent = os.sendfile(f.fileno(), src.fileno(), offset, 1 << 30)
+                if not sent:
+                    break
+                offset += sent
+        else:
+            shutil.copyfileobj(src, f, length=1 << 20)
+
+
 class TaskStatus(Enum):
     QUEUED = 0
     PREPROCESSING = 1
@@ -17,6 +56,10 @@ class TaskStatus(Enum):
     RENDERING = 3
     DONE = 4
     FAILED = 5
+    CANCELLED = 6
+
+
+FINISHED_STATUSES = {TaskStatus.DONE, TaskStatus.FAILED, TaskStatus.CANCELLED}
 
 
 class ExecutionStrategy(str, Enum):
@@ -31,52 +74,110 @@ class Task(BaseModel):
     status: TaskStatus
     error: Union[str, None]
     execution_strategy: ExecutionStrategy
-
-    def upload_images(self, files: List[UploadFile]):
-        images_dir = self.images_dir()
+    config_file: Union[str, None] = None
+    # GPU the task is training or rendering on
+    gpu: Union[int, None] = None
+    # paths are kept out of the fields so they are not serialized
+    _paths: Dict[str, str] = PrivateAttr(default_factory=dict)
+    _log_fd: Union[int, None] = PrivateAttr(default=None)
+
+    class Config:
+        # status and error are updated by the task manager as the task runs,
+        # there is no need to validate those assignments
+        validate_assignment = False
+        extra = Extra.forbid
+
+    async def upload_images(self, files: List[UploadFile]):
+        images_dir = self.images_dir
         makedirs(images_dir, exist_ok=True)
-        for i, file in enumerate(files):
-            filename = f'image-{i}.jpg'
-            with open(path.join(images_dir, filename), 'wb+') as f:
-                f.write(file.file.read())
-
-    def upload_video(self, video: UploadFile):
-        images_dir = self.images_dir()
+        filenames = [f'image-{i:04d}.jpg' for i in range(len(files))]
+        # cap concurrent writes to avoid running out of file descriptors
+        sem = asyncio.Semaphore(16)
+        # open the images relative to the directory to skip resolving the
+        # full path for every file
+        dir_fd = os.open(images_dir, os.O_RDONLY | os.O_DIRECTORY)
+
+        async def upload_image(filename: str, file: UploadFile):
+            async with sem:
+                await asyncio.to_thread(_save_upload, file, filename, dir_fd)
+
+        try:
+            await asyncio.gather(
+                *[upload_image(filename, file)
+                  for filename, file in zip(filenames, files)])
+        finally:
+            os.close(dir_fd)
+
+    async def upload_video(self, video: UploadFile):
+        images_dir = self.images_dir
         makedirs(images_dir, exist_ok=True)
-        with open(self.input_video_file(), 'wb+') as f:
-            f.write(video.file.read())
-        system(f"ffmpeg -i {self.input_video_file()} -qscale:v 1 -qmin 1 -vf \"fps=2\" {self.images_dir()}/%04d.jpg")
-
+        await asyncio.to_thread(_save_upload, video, self.input_video_file)
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-i", self.input_video_file, "-qscale:v", "1",
+            "-qmin", "1", "-vf", "fps=2", f"{images_dir}/%04d.jpg",
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=self.log_fd(), stderr=asyncio.subprocess.STDOUT)
+        status = await proc.wait()
+        if status != 0:
+            raise RuntimeError(
+                f"Cannot extract frames from video, ffmpeg exit with status code {status}")
+
+    def log_fd(self) -> int:
+        """
+        Return a file descriptor of the log file of the task, opening it on
+        first use
+        """
+        if self._log_fd is None:
+            makedirs(path.dirname(self.log_file), exist_ok=True)
+            self._log_fd = os.open(
+                self.log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        return self._log_fd
+
+    def close_log(self):
+        """Close the log file of the task if it is open"""
+        if self._log_fd is not None:
+            os.close(self._log_fd)
+            self._log_fd = None
+
+    @_cached_path
     def task_dir(self):
-        return path.join(tasks_dir, str(self.id))
+        return path.join(tasks_dir, self.id)
 
+    @_cached_path
     def dataset_dir(self):
-        return path.join(self.task_dir(), 'dataset')
+        return path.join(self.task_dir, dataset_subdir)
 
+    @_cached_path
     def images_dir(self):
-        return path.join(self.dataset_dir(), 'images')
+        return path.join(self.task_dir, images_subdir)
 
+    @_cached_path
     def model_dir(self):
-        return path.join(self.task_dir(), 'model')
+        return path.join(self.task_dir, model_subdir)
 
+    @_cached_path
     def log_file(self):
-        return path.join(self.task_dir(), 'log.txt')
+        return path.join(self.task_dir, log_subpath)
 
+    @_cached_path
     def transforms_file(self):
-        return path.join(self.dataset_dir(), 'transforms.json')
+        return path.join(self.task_dir, transforms_subpath)
 
+    @_cached_path
     def output_video_file(self):
-        return path.join(self.task_dir(), 'output', 'render_output.mp4')
+        return path.join(self.task_dir, output_video_subpath)
 
+    @_cached_path
     def input_video_file(self):
-        return path.join(self.dataset_dir(), 'input_video.mp4')
+        return path.join(self.task_dir, input_video_subpath)
 
     @staticmethod
     def new(execution_strategy: str):
-        return Task(
+        # every field is built here, skip validation
+        return Task.construct(
             id=str(uuid4()),
             status=TaskStatus.QUEUED,
             created_at=datetime.now(),
             error=None,
-            execution_strategy=execution_strategy)
+            execution_strategy=ExecutionStrategy(execution_strategy))
 
@@ -1,91 +1,264 @@
 import asyncio
-from typing import Dict
-
-import traceback
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from itertools import islice
+import os
+import shutil
+from typing import Dict, List, Type, Union
 
 from config import *
 from execution_strategy import NerfactoStrategy, InstantNgpStrategy, VanillaNerfStrategy
-from models import Task, TaskStatus, ExecutionStrategy
+from execution_strategy import ExecutionStrategy as Strategy
+from models import Task, TaskStatus, ExecutionStrategy, FINISHED_STATUSES
+from log_writer import log_writer
+from task_store import TaskStore
+
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES: Dict[ExecutionStrategy, Type[Strategy]] = {
+    ExecutionStrategy.nerfacto: NerfactoStrategy,
+    ExecutionStrategy.instant_ngp: InstantNgpStrategy,
+    ExecutionStrategy.vanilla_nerf: VanillaNerfStrategy,
+}
 
 
 class TaskManager:
     """Keep track of current tasks and process the tasks in the queue"""
 
     def __init__(self):
-        self.tasks: Dict[str, Task] = dict()
-        self.queue: asyncio.Queue[Task] = asyncio.Queue(maxsize=10)
-        asyncio.get_event_loop()
-        self.exec_task = asyncio.create_task(self._execute())
+        # in the order the tasks were added, the oldest finished tasks are
+        # evicted once there are more than max_tasks
+        self.tasks: OrderedDict[str, Task] = OrderedDict()
+        # bumped whenever a task is added or changes
+        self._version = 0
+        self._list_cache = "[]"
+        self._list_cache_version = 0
+        # tasks added but not done, failed or cancelled yet
+        self.in_flight = 0
+        # each stage has its own queue so that a task can preprocess on the
+        # CPU while another one trains or renders on the GPU
+        # tasks waiting to be preprocessed in arrival order, indexed by id so
+        # that a queued task can be cancelled
+        self.queue: OrderedDict[str, Task] = OrderedDict()
+        self.queue_cond = asyncio.Condition()
+        self.train_queue: asyncio.Queue[Task] = asyncio.Queue()
+        self.render_queue: asyncio.Queue[Task] = asyncio.Queue()
+        # GPUs not used by a training or rendering task
+        self.free_gpus: asyncio.Queue[int] = asyncio.Queue()
+        for gpu in range(gpu_count):
+            self.free_gpus.put_nowait(gpu)
+        self.store = TaskStore(tasks_db)
+        self._restore()
+        self.exec_tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        """Start processing tasks on the running event loop"""
+        log_writer.start()
+        self.exec_tasks = [
+            *[asyncio.create_task(self._preprocess_worker())
+              for _ in range(preprocess_slots)],
+            *[asyncio.create_task(self._train_worker())
+              for _ in range(gpu_count)],
+            *[asyncio.create_task(self._render_worker())
+              for _ in range(gpu_count)],
+        ]
 
-    def add(self, task: Task) -> bool:
+    def _restore(self):
+        """Reload the stored tasks and queue the unfinished ones again"""
+        for task in self.store.load():
+            self.tasks[task.id] = task
+            if task.status in FINISHED_STATUSES:
+                continue
+            # whatever step the task was in was interrupted, start it over
+            # without the partial training run and video it left behind
+            shutil.rmtree(task.model_dir, ignore_errors=True)
+            try:
+                os.remove(task.output_video_file)
+            except FileNotFoundError:
+                pass
+            task.status = TaskStatus.QUEUED
+            task.config_file = None
+            task.gpu = None
+            self.store.update(task)
+            self.queue[task.id] = task
+            self.in_flight += 1
+        self._version += 1
+
+    async def stop(self):
+        """Stop processing tasks"""
+        for exec_task in self.exec_tasks:
+            exec_task.cancel()
+        await asyncio.gather(*self.exec_tasks, return_exceptions=True)
+        self.store.close()
+
+    async def add(self, task: Task) -> bool:
         """
         Add new task to the task queue to be executed
 
-        return True on success False on failure (saturated task queue)
+        return True on success False on failure (too many tasks in flight)
         """
-        self.tasks[task.id] = task
+        if self.in_flight >= max_tasks_in_flight:
+            return False
+        # reserve the slot before waiting for the store so that concurrent
+        # requests cannot all pass the check above
+        self.in_flight += 1
         try:
-            self.queue.put_nowait(task)
-            return True
-        except asyncio.QueueFull:
+            await asyncio.wrap_future(self.store.insert(task))
+        except BaseException:
+            self.in_flight -= 1
+            raise
+        self.tasks[task.id] = task
+        self._version += 1
+        self._evict()
+        async with self.queue_cond:
+            self.queue[task.id] = task
+            self.queue_cond.notify()
+        return True
+
+    def cancel(self, task_id: str) -> bool:
+        """
+        Cancel a task that is still waiting in the task queue
+
+        return True on success False if the task is not queued
+        """
+        task = self.queue.pop(task_id, None)
+        if task is None:
             return False
+        self._finish(task, TaskStatus.CANCELLED)
+        return True
 
-    def get(self, task_id: str):
+    def get(self, task_id: str) -> Union[Task, None]:
         """
         Get task by task id
 
         return None if task not found
         """
-        if task_id in self.tasks:
-            return self.tasks[task_id]
-        return None
+        return self.tasks.get(task_id)
+
+    def list_json(self) -> str:
+        """
+        Return all tasks serialized as a JSON array
+
+        The result is cached until a task is added or changes
+        """
+        if self._list_cache_version != self._version:
+            self._list_cache = \
+                "[" + ",".join(task.json() for task in self.tasks.values()) + "]"
+            self._list_cache_version = self._version
+        return self._list_cache
 
-    def list(self):
-        """Return all tasks"""
-        return list(self.tasks.values())
+    @staticmethod
+    def _execution_strategy(task: Task):
+        """Return the execution strategy used to process task"""
+        return STRATEGIES.get(task.execution_strategy, NerfactoStrategy)
 
-    async def _execute(self):
-        """Process tasks added to the task queue"""
+    def _evict(self):
+        """Forget the oldest finished tasks and delete their files"""
+        excess = len(self.tasks) - max_tasks
+        if excess <= 0:
+            return
+        finished = islice(
+            (task for task in self.tasks.values()
+             if task.status in FINISHED_STATUSES),
+            excess)
+        loop = asyncio.get_running_loop()
+        for task in list(finished):
+            del self.tasks[task.id]
+            self.store.delete(task.id)
+            loop.run_in_executor(None, shutil.rmtree, task.task_dir, True)
+        self._version += 1
+
+    def _set_status(self, task: Task, status: TaskStatus):
+        """Update the status of task and invalidate the cached task list"""
+        task.status = status
+        self._version += 1
+        self.store.update(task)
+
+    def _finish(self, task: Task, status: TaskStatus):
+        """Move task to a final status and release its resources"""
+        self._set_status(task, status)
+        task.close_log()
+        self.in_flight -= 1
+
+    def _fail(self, task: Task, error: str):
+        """Mark task as failed with the given error message"""
+        task.error = error
+        self._finish(task, TaskStatus.FAILED)
+
+    @asynccontextmanager
+    async def _use_gpu(self, task: Task):
+        """Run task on a free GPU for the duration of the context"""
+        gpu = await self.free_gpus.get()
+        task.gpu = gpu
+        self._version += 1
+        try:
+            yield
+        finally:
+            task.gpu = None
+            # also covers the config file recorded by training
+            self._version += 1
+            self.free_gpus.put_nowait(gpu)
+
+    async def _preprocess_worker(self):
+        """Preprocess queued tasks and pass them on to training"""
         while True:
-            task = await self.queue.get()
-            if task.execution_strategy == ExecutionStrategy.nerfacto:
-                execution_strategy = NerfactoStrategy()
-            elif task.execution_strategy == ExecutionStrategy.instant_ngp:
-                execution_strategy = InstantNgpStrategy()
-            elif task.execution_strategy == ExecutionStrategy.vanilla_nerf:
-                execution_strategy = VanillaNerfStrategy()
-            else:
-                execution_strategy = NerfactoStrategy()
-
-            print(f"running task: {task}")
+            async with self.queue_cond:
+                await self.queue_cond.wait_for(lambda: self.queue)
+                _, task = self.queue.popitem(last=False)
+            execution_strategy = self._execution_strategy(task)
+            logger.info("running task: %s", task)
             try:
-                task.status = TaskStatus.PREPROCESSING
+                self._set_status(task, TaskStatus.PREPROCESSING)
                 await asyncio.wait_for(
                         execution_strategy.preprocess(task),
-                        timeout=execution_strategy.preprocess_timeout())
-                task.status = TaskStatus.TRAINING
-                try: 
+                        timeout=execution_strategy.preprocess_timeout)
+            except asyncio.TimeoutError:
+                self._fail(task, "Timeout on preprocessing")
+                continue
+            except Exception as e:
+                logger.exception("task %s failed", task.id)
+                self._fail(task, str(e))
+                continue
+            self.train_queue.put_nowait(task)
+
+    async def _train_worker(self):
+        """Train preprocessed tasks and pass them on to rendering"""
+        while True:
+            task = await self.train_queue.get()
+            execution_strategy = self._execution_strategy(task)
+            try:
+                async with self._use_gpu(task):
+                    self._set_status(task, TaskStatus.TRAINING)
                     await asyncio.wait_for(
-                        execution_strategy.train(task),
-                        timeout=execution_strategy.train_timeout())
-                except asyncio.TimeoutError:
-                    print("training timed out, moving onto rendering")
-                task.status = TaskStatus.RENDERING
-                await asyncio.wait_for(
-                        execution_strategy.render(task),
-                        timeout=execution_strategy.render_timeout())
-                task.status = TaskStatus.DONE
-                print("done running task")
+                            execution_strategy.train(task),
+                            timeout=execution_strategy.train_timeout)
+            except asyncio.TimeoutError:
+                logger.info("training timed out, moving onto rendering")
+            except Exception as e:
+                logger.exception("task %s failed", task.id)
+                self._fail(task, str(e))
+                continue
+            self.render_queue.put_nowait(task)
+
+    async def _render_worker(self):
+        """Render trained tasks"""
+        while True:
+            task = await self.render_queue.get()
+            execution_strategy = self._execution_strategy(task)
+            try:
+                async with self._use_gpu(task):
+                    self._set_status(task, TaskStatus.RENDERING)
+                    await asyncio.wait_for(
+                            execution_strategy.render(task),
+                            timeout=execution_strategy.render_timeout)
             except asyncio.TimeoutError:
-                task.error = "Timeout on "
-                if task.status == TaskStatus.PREPROCESSING:
-                    task.error += "preprocessing"
-                elif task.status == TaskStatus.TRAINING:
-                    task.error += "training"
-                elif task.status == TaskStatus.RENDERING:
-                    task.error += "rendering"
-                task.status = TaskStatus.FAILED
+                self._fail(task, "Timeout on rendering")
+                continue
             except Exception as e:
-                print(traceback.print_exc())
-                task.error = str(e)
-                task.status = TaskStatus.FAILED
+                logger.exception("task %s failed", task.id)
+                self._fail(task, str(e))
+                continue
+            self._finish(task, TaskStatus.DONE)
+            logger.info("done running task %s", task.id)
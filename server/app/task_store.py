@@ -0,0 +1,111 @@
+from concurrent.futures import Future
+import logging
+from os import makedirs, path
+import queue
+import sqlite3
+import threading
+from typing import List
+
+from models import Task
+
+
+logger = logging.getLogger(__name__)
+
+
+class TaskStore:
+    """
+    Persist tasks in a SQLite database so that they survive a server restart
+
+    Writes are done by a background thread, which commits up to batch_size
+    queued writes in one transaction
+    """
+
+    def __init__(self, db_file: str, batch_size: int = 32):
+        makedirs(path.dirname(db_file), exist_ok=True)
+        self.batch_size = batch_size
+        self.db = sqlite3.connect(
+            db_file, check_same_thread=False, isolation_level=None)
+        # WAL with synchronous=NORMAL only syncs at checkpoints, a commit is
+        # a sequential append to the log
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                id TEXT PRIMARY KEY,
+                status INTEGER NOT NULL,
+                data TEXT NOT NULL
+            )""")
+        # (statement, parameters, future resolved on commit or None) tuples,
+        # None stops the writer
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def load(self) -> List[Task]:
+        """Return every stored task in the order they were added"""
+        rows = self.db.execute("SELECT data FROM tasks ORDER BY rowid")
+        return [Task.parse_raw(data) for (data,) in rows]
+
+    def insert(self, task: Task) -> Future:
+        """
+        Store a new task
+
+        return a future that is resolved once the task is committed
+        """
+        done = Future()
+        self.queue.put((
+            "INSERT INTO tasks VALUES (?, ?, ?)",
+            (task.id, task.status.value, task.json()),
+            done))
+        return done
+
+    def update(self, task: Task):
+        """Store the current state of task, committed with the next batch"""
+        self.queue.put((
+            "UPDATE tasks SET status = ?, data = ? WHERE id = ?",
+            (task.status.value, task.json(), task.id),
+            None))
+
+    def delete(self, task_id: str):
+        """Remove a task, committed with the next batch"""
+        self.queue.put(("DELETE FROM tasks WHERE id = ?", (task_id,), None))
+
+    def close(self):
+        """Commit the queued writes and close the database"""
+        self.queue.put(None)
+        self.writer.join()
+        self.db.close()
+
+    def _write(self):
+        closed = False
+        while not closed:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                closed = True
+                batch = [write for write in batch if write is not None]
+
+            error = None
+            try:
+                self.db.execute("BEGIN")
+                for statement, params, _ in batch:
+                    self.db.execute(statement, params)
+                self.db.execute("COMMIT")
+            except sqlite3.Error as e:
+                logger.exception("Failed to store tasks")
+                if self.db.in_transaction:
+                    self.db.execute("ROLLBACK")
+                error = e
+            for _, _, done in batch:
+                # skip futures cancelled by their caller, afterwards they can
+                # no longer be cancelled
+                if done is None or not done.set_running_or_notify_cancel():
+                    continue
+                if error:
+                    done.set_exception(error)
+                else:
+                    done.set_result(None)